@@ -14,7 +14,7 @@ from . import settings
 from .network import fetch
 
 # Define constants
-DBVERSION = "9"
+DBVERSION = "10"
 
 SQL = f"""
     CREATE TABLE repec (
@@ -91,6 +91,12 @@ SQL = f"""
         ('version', {DBVERSION});
 """
 
+INDICES = """
+    CREATE INDEX IF NOT EXISTS listings_status ON listings (status, url);
+    CREATE INDEX IF NOT EXISTS papers_nojournal ON papers (template, handle)
+        WHERE journal IS NULL;
+"""
+
 
 def jcode(item):
     """Get JEL code."""
@@ -130,13 +136,44 @@ def prepare(path):
         raise RuntimeError("Database already exists")
     conn = sqlite3.connect(path)
     conn.executescript(SQL)
+    ensure_indices(conn)
     populate_jel(conn)
 
 
+def ensure_indices(conn):
+    """Create indices absent from version 9 databases."""
+    conn.executescript(INDICES)
+
+
+def migrate_9(conn):
+    """Migrate a version 9 database: lower-case paper handles, add indices."""
+    print(f"Migrating database to version {DBVERSION}...")
+    with conn:
+        # Of the handles that differ in case only, keep the latest record
+        conn.execute(
+            "DELETE FROM papers WHERE pid NOT IN"
+            " (SELECT max(pid) FROM papers GROUP BY lower(handle))"
+        )
+        conn.execute("DELETE FROM authors WHERE pid NOT IN (SELECT pid FROM papers)")
+        conn.execute(
+            "DELETE FROM papers_jel WHERE pid NOT IN (SELECT pid FROM papers)"
+        )
+        conn.execute(
+            "UPDATE papers SET handle = lower(handle) WHERE handle != lower(handle)"
+        )
+        sql = "UPDATE meta SET value = ? WHERE parameter = 'version'"
+        conn.execute(sql, (DBVERSION,))
+    ensure_indices(conn)
+
+
 def check_version():
-    """Verify database version."""
+    """Verify database version, migrate older databases."""
     sql = "SELECT value FROM meta WHERE parameter = 'version'"
     conn = sqlite3.connect(settings.database)
     (version,) = conn.execute(sql).fetchone()
+    if version == "9":
+        migrate_9(conn)
+        (version,) = conn.execute(sql).fetchone()
+    conn.close()
     if version != DBVERSION:
         raise RuntimeError("Incompatible database version")
@@ -1,11 +1,21 @@
+import re
 import sqlite3
-import json
-import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 import nameparser
 from titlecase import titlecase
 
 # Load local packages
 from . import settings
+from .redif import unpack
+
+BUFSIZE = 1 << 20  # 1 MiB
+CHUNK_SIZE = 200  # records per worker task
+
+RFS_RECEIVED = re.compile(
+    "Received ?(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)"
+)
 
 
 def export(handle: str = "", export_bib_file=settings.export_bib):
@@ -13,45 +23,53 @@ def export(handle: str = "", export_bib_file=settings.export_bib):
     assert len(handle) > 0
     conn = sqlite3.connect(settings.database, check_same_thread=False)
     c = conn.cursor()
-    c.execute(f'select redif from papers where lower(handle) like "{handle}%"')
-    results = c.fetchall()
+    c.arraysize = CHUNK_SIZE
+    c.execute("SELECT redif FROM papers WHERE handle GLOB ?", (handle.lower() + "*",))
+    chunks = []
+    while rows := c.fetchmany():
+        chunks.append([res[0] for res in rows])
     c.close()
-    if len(results) == 0:
+    if len(chunks) == 0:
         raise RuntimeWarning("No papers in database matching the handle")
 
     match handle.lower():
         # Journal of Financial Economics
         case "repec:eee:jfinec":
-            if not check_urls_jfe(results):
-                raise RuntimeWarning("Some papers' urls are missing")
-            with open(export_bib_file, "w", encoding="utf-8") as f:
-                for res in results:
-                    parse_redif_jfe(res[0], f)
+            parse, check = parse_redif_jfe, check_urls_jfe
         # Review of Financial Studies
         case "repec:oup:rfinst":
-            # if not check_urls_rfs(results):
-            #     raise RuntimeWarning("Some papers' urls are missing")
             # Some do not have file-url
             # len(results)=2427, n_has_file_url=2186
-            with open(export_bib_file, "w", encoding="utf-8") as f:
-                for res in results:
-                    parse_redif_rfs(res[0], f)
+            parse, check = parse_redif_rfs, None
         # Journal of Finance
         case "repec:bla:jfinan":
-            # if not check_urls_jof(results):
-            #     raise RuntimeWarning("Some papers' urls are missing")
             # Some do not have file-url
-            with open(export_bib_file, "w", encoding="utf-8") as f:
-                for res in results:
-                    parse_redif_jof(res[0], f)
+            parse, check = parse_redif_jof, None
+        case _:
+            return
+
+    # Records are independent, parse them in worker processes
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(export_chunk, repeat(parse), repeat(check), chunks))
+    if not all(ok for ok, _ in results):
+        raise RuntimeWarning("Some papers' urls are missing")
+    with open(export_bib_file, "w", encoding="utf-8", buffering=BUFSIZE) as f:
+        for _, entries in results:
+            f.writelines(entries)
+
+
+def export_chunk(parse, check, blobs: list):
+    """Parse a chunk of stored records into bib entries"""
+    results = [unpack(blob) for blob in blobs]
+    if check and not check(results):
+        return False, []
+    return True, [parse(redif) for redif in results]
 
 
 def check_urls_jfe(results: list):
     """Check all records contain file-url"""
     n_has_file_url = 0
-    for res in results:
-        redif = zlib.decompress(res[0])
-        redif = json.loads(redif)
+    for redif in results:
         for rec in redif:
             if rec[0] == "file-url":
                 n_has_file_url += 1
@@ -67,9 +85,7 @@ def check_urls_jof(results: list):
     return check_urls_jfe(results)
 
 
-def parse_redif_jfe(redif_data: bytes, f):
-    redif = zlib.decompress(redif_data)
-    redif = json.loads(redif)
+def parse_redif_jfe(redif: list) -> str:
     bib = dict()
     authors = []
     for rec in redif:
@@ -90,7 +106,7 @@ def parse_redif_jfe(redif_data: bytes, f):
                 bib["title"] = titlecase(title)
             case k, v:
                 bib[k] = v
-    authors = [name for name in sorted(authors)]
+    authors = sorted(authors)
     bib["author"] = " AND ".join(authors)
     # JFE missing journal fiel
     bib["journal"] = "Journal of Financial Economics"
@@ -100,14 +116,17 @@ def parse_redif_jfe(redif_data: bytes, f):
     citekey += title.split(" ")[0]
     citekey = citekey.lower()
 
-    print(f"@article{{{citekey},", file=f)
-    print("\n".join(f"{k} = {{ {v} }}," for k, v in bib.items()), file=f)
-    print("}", file=f)
+    return format_entry(citekey, bib)
+
 
+@lru_cache(maxsize=50000)
+def parse_name(author: str) -> str:
+    """Format an author name as last, first middle"""
+    name = nameparser.HumanName(author)
+    return f"{name.last}, {name.first} {name.middle}"
 
-def parse_redif_rfs(redif_data: bytes, f):
-    redif = zlib.decompress(redif_data)
-    redif = json.loads(redif)
+
+def parse_redif_rfs(redif: list) -> str:
     bib = dict()
     authors = []
     for rec in redif:
@@ -117,9 +136,7 @@ def parse_redif_rfs(redif_data: bytes, f):
             # TODO: RFS lists the Editor as an "author"...
             # I have no idea how to clean it.
             case "author-name", author:
-                name = nameparser.HumanName(author)
-                name = f"{name.last}, {name.first} {name.middle}"
-                authors.append(name)
+                authors.append(parse_name(author))
             case "file-url", url:
                 if url.startswith("http://www.jstor.org/fcgi-bin"):
                     url = ""
@@ -129,15 +146,8 @@ def parse_redif_rfs(redif_data: bytes, f):
                 abstract = "".join(abstract.splitlines())
                 if (idx := abstract.rfind("The Author ")) != -1:
                     abstract = abstract[:idx]
-                # fmt: off
-                for month in ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]:
-                    txt = f"Received {month}"
-                    if (idx := abstract.find(txt)) != -1:
-                        abstract = abstract[:idx]
-                    txt = f"Received{month}"
-                    if (idx := abstract.find(txt)) != -1:
-                        abstract = abstract[:idx]
-                # fmt: on
+                if m := RFS_RECEIVED.search(abstract):
+                    abstract = abstract[: m.start()]
                 abstract = abstract.replace(
                     "Article published by Oxford University Press on behalf of the Society for Financial Studies in its journal, The Review of Financial Studies.",
                     "",
@@ -149,7 +159,7 @@ def parse_redif_rfs(redif_data: bytes, f):
                 bib["title"] = titlecase(title)
             case k, v:
                 bib[k] = v
-    authors = [name for name in sorted(authors)]
+    authors = sorted(authors)
     bib["author"] = " AND ".join(authors)
     # JFE missing journal fiel
     bib["journal"] = "Review of Financial Studies"
@@ -159,14 +169,10 @@ def parse_redif_rfs(redif_data: bytes, f):
     citekey += title.split(" ")[0]
     citekey = citekey.lower()
 
-    print(f"@article{{{citekey},", file=f)
-    print("\n".join(f"{k} = {{ {v} }}," for k, v in bib.items()), file=f)
-    print("}", file=f)
+    return format_entry(citekey, bib)
 
 
-def parse_redif_jof(redif_data: bytes, f):
-    redif = zlib.decompress(redif_data)
-    redif = json.loads(redif)
+def parse_redif_jof(redif: list) -> str:
     bib = dict()
     authors = []
     for rec in redif:
@@ -211,7 +217,7 @@ def parse_redif_jof(redif_data: bytes, f):
                 pass
             case k, v:
                 bib[k] = v
-    authors = [name for name in sorted(authors)]
+    authors = sorted(authors)
     bib["author"] = " AND ".join(authors)
     # JFE missing journal fiel
     bib["journal"] = "The Journal of Finance"
@@ -221,9 +227,15 @@ def parse_redif_jof(redif_data: bytes, f):
     citekey += title.split(" ")[0]
     citekey = citekey.lower()
 
-    print(f"@article{{{citekey},", file=f)
-    print("\n".join(f"{k} = {{ {v} }}," for k, v in bib.items()), file=f)
-    print("}", file=f)
+    return format_entry(citekey, bib)
+
+
+def format_entry(citekey: str, bib: dict) -> str:
+    """Format a single bib entry"""
+    lines = [f"@article{{{citekey},\n"]
+    lines.extend(f"{k} = {{ {v} }},\n" for k, v in bib.items())
+    lines.append("}\n")
+    return "".join(lines)
 
 
 def format_last_name(name: str) -> str:
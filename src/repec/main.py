@@ -51,6 +51,8 @@ def export(args):
     settings.database = args.database
     settings.export_bib = args.out_bib
 
+    database.check_version()  # Abort on incompatible versions
+
     if args.handle:
         export_bib.export(args.handle, args.out_bib)
 
@@ -123,7 +125,7 @@ def main():
         default=settings.batch_size,
         metavar="SIZE",
         help=(
-            "Number of papers to commit in a single transaction"
+            "Number of ReDIF documents to download in a single batch"
             f" (default: {settings.batch_size:,})"
         ),
     )
@@ -7,13 +7,12 @@
 from urllib.parse import urlparse
 import re
 import sqlite3
-import json
-import zlib
 import threading
 import random
 import math
 import cld2
 from collections import defaultdict
+from functools import lru_cache
 
 # Load local packages
 from . import settings
@@ -22,11 +21,41 @@ from .misc import iserror, silent, parallel
 from .sanitize import sanitize, sanitize_email
 from .network import fetch, fetch_curl
 
+# Define constants
+TTYPE = re.compile(r"redif-(\S*)")
+TEMPLATE = re.compile("edif-([a-z]+)", flags=re.I)
+YEAR = re.compile("(?<![0-9])[0-9]{4}")
+JEL_DOT = re.compile("([A-Z])[-., ]+([0-9])")
+JEL_CODE = re.compile("(?<![A-Z0-9])([A-Z][0-9]{1,2})[0-9]*(?![A-Z0-9])")
+
+FIELDS = set([
+    "handle",
+    "template-type",
+    "title",
+    "abstract",
+    "journal",
+    "volume",
+    "issue",
+    "pages",
+    "language",
+    "classification-jel",
+])
+DATES = set(["year", "creation-date", "revision-date"])
+CHUNK_SIZE = 500  # papers rows per INSERT statement
+
+REPLACE_SQL = (
+    "REPLACE INTO papers (url, handle, template, title, abstract, journal,"
+    " volume, issue, pages, language, year, redif) VALUES "
+)
+REPLACE_ROW = "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+HANDLE = 1  # position of handle in a papers row
+LOCK_RETRIES = 3  # write attempts per document, each up to busy_timeout
+
 
 def ttype(record):
     """Get template type."""
     tt = next(v for k, v in record if k == "template-type")
-    return re.match(r"redif-(\S*)", tt.lower()).group(1)
+    return TTYPE.match(tt.lower()).group(1)
 
 
 @silent
@@ -61,9 +90,7 @@ def filterjel(jel, alljel):
 
 def parsejel(jel, alljel):
     """Parse JEL using ad-hoc rules."""
-    jel = re.sub("([A-Z])[-., ]+([0-9])", r"\1\2", jel)
-    jel = re.split("[^A-Z0-9]+", jel.upper())
-    jel = [c[:3] for c in jel if re.match("[A-Z][0-9]+$", c)]
+    jel = JEL_CODE.findall(JEL_DOT.sub(r"\1\2", jel).upper())
     jel = [filterjel(c, alljel) for c in jel]
     jel = sorted(set(c for c in jel if c))
     # Do not include JEL for papers that blindly follow the online example
@@ -74,13 +101,13 @@ def parsejel(jel, alljel):
 
 def parse_template(template):
     """Parse broken template specification."""
-    m = re.search("edif-([a-z]+)", template, flags=re.I)
+    m = TEMPLATE.search(template)
     return m.group(1).lower() if m else None
 
 
 def parse_year(date):
     """Parse broken date specification."""
-    m = re.search("(?<![0-9])[0-9]{4}", date)
+    m = YEAR.search(date)
     y = m.group(0) if m else None
     return int(y) if y and y != "0000" else None
 
@@ -95,6 +122,7 @@ def get_year(paper):
     return None
 
 
+@lru_cache(maxsize=65536)
 def detect_language(text):
     """Detect language using CLD2 library."""
     try:  # todo: figure out what's causing an occasional error
@@ -107,7 +135,7 @@ def detect_language(text):
 
 def lang_and(*text, default=None):
     """Determine common language."""
-    lang = set(detect_language(t) for t in text if t)
+    lang = set(detect_language(t) for t in set(text) if t)
     if len(lang) == 1:
         lang = lang.pop()
         if lang:
@@ -115,73 +143,172 @@ def lang_and(*text, default=None):
     return default
 
 
-def replace_paper(c, paper, url, alljel):
-    """Update a single paper record."""
-    blob = json.dumps(paper, ensure_ascii=False).encode(encoding="utf-8")
-    paper = redif.collect(paper)
-    r = {}
-    r["url"] = url
-    r["handle"] = paper["handle"][0]
-    r["template"] = parse_template(paper["template-type"][0])
-    for f in ["title", "abstract", "journal", "volume", "issue", "pages"]:
-        r[f] = paper.get(f, [None])[0]
-    for f in ["title", "abstract", "journal"]:
-        r[f] = sanitize(r[f])
-    r["language"] = paper.get("language", ["none"])[0].lower()
-    r["language"] = r["language"] if len(r["language"]) == 2 else None
-    r["language"] = lang_and(r["title"], r["abstract"], default=r["language"])
-    r["year"] = get_year(paper)
-    r["redif"] = zlib.compress(blob, level=9)
-
-    sql = "REPLACE INTO papers (" + ", ".join(k for k in r.keys()) + ")"
-    sql += " VALUES (" + ", ".join(["?"] * len(r)) + ")"
-    c.execute(sql, list(r.values()))
-    pid = c.lastrowid
-
-    if "author" in paper:
-        authors = [a for a in paper["author"] if type(a) == defaultdict]
-        authors = [
-            (sanitize(a["name"][0]), sanitize_email(a.get("email", [None])[0]))
-            for a in authors
-        ]
-        authors = [(pid, n, e) for n, e in authors if n]
-        sql = "INSERT INTO authors (pid, name, email) VALUES (?, ?, ?)"
-        c.executemany(sql, authors)
+def destructure(paper):
+    """Extract fields, dates and (name, email) authors in a single pass."""
+    fields = {}
+    dates = defaultdict(list)
+    authors = []
+    author = None
+    for k, v in paper:
+        if k.startswith("author-"):
+            # Same grouping as redif.collect: a cluster per author-name
+            if k == "author-name":
+                author = [v, None]
+                authors.append(author)
+            elif k == "author-email" and author and author[1] is None:
+                author[1] = v
+            continue
+        author = None
+        if k in DATES:
+            dates[k].append(v)
+        elif k in FIELDS:
+            fields.setdefault(k, v)
+    return fields, dates, authors
+
+
+def prepare_paper(paper, url, alljel):
+    """Build the papers row, the authors and the JEL codes of a paper."""
+    blob = redif.pack(paper)
+    paper, dates, authors = destructure(paper)
+    title = sanitize(paper.get("title"))
+    abstract = sanitize(paper.get("abstract"))
+    language = paper.get("language", "none").lower()
+    language = language if len(language) == 2 else None
+    row = (
+        url,
+        paper["handle"].lower(),
+        parse_template(paper["template-type"]),
+        title,
+        abstract,
+        sanitize(paper.get("journal")),
+        paper.get("volume"),
+        paper.get("issue"),
+        paper.get("pages"),
+        lang_and(title, abstract, default=language),
+        get_year(dates),
+        blob,
+    )
+
+    authors = [(sanitize(n), sanitize_email(e)) for n, e in authors]
+    authors = [(n, e) for n, e in authors if n]
     if "classification-jel" in paper:
-        jel = parsejel(paper["classification-jel"][0], alljel)
-        jel = [(pid, c) for c in jel]
-        c.executemany("INSERT INTO papers_jel (pid, code) VALUES (?, ?)", jel)
-
-
-def update_papers_1(conn, lock, url, alljel):
-    """Update papers from a single ReDIF document."""
-    papers = load(url)
-    with lock:
-        c = conn.cursor()
+        jel = parsejel(paper["classification-jel"], alljel)
+    else:
+        jel = []
+    return row, authors, jel
+
+
+@lru_cache(maxsize=None)
+def replace_sql(n):
+    """Build a REPLACE statement for n papers rows."""
+    return REPLACE_SQL + ", ".join([REPLACE_ROW] * n) + " RETURNING handle, pid"
+
+
+def insert_papers(c, rows):
+    """Insert papers rows, return a handle -> pid mapping."""
+    if sqlite3.sqlite_version_info < (3, 35, 0):  # No RETURNING clause
+        pids = {}
+        for r in rows:
+            c.execute(REPLACE_SQL + REPLACE_ROW, r)
+            pids[r[HANDLE]] = c.lastrowid
+        return pids
+    c.execute(replace_sql(len(rows)), [v for r in rows for v in r])
+    return dict(c.fetchall())
+
+
+def prepare_papers(papers, url, alljel):
+    """Prepare paper records from a single ReDIF document."""
+    # A repeated handle replaces the earlier paper, as with row-wise REPLACE
+    records = {}
+    for paper in papers:
+        r, authors, jel = prepare_paper(paper, url, alljel)
+        records.pop(r[HANDLE], None)
+        records[r[HANDLE]] = (r, authors, jel)
+    return list(records.values())
+
+
+def replace_papers(c, records):
+    """Write prepared paper records."""
+    pids = {}
+    for i in range(0, len(records), CHUNK_SIZE):
+        rows = [r for r, _, _ in records[i : i + CHUNK_SIZE]]
+        pids.update(insert_papers(c, rows))
+
+    authors = [(pids[r[HANDLE]], n, e) for r, aa, _ in records for n, e in aa]
+    sql = "INSERT INTO authors (pid, name, email) VALUES (?, ?, ?)"
+    c.executemany(sql, authors)
+    jel = [(pids[r[HANDLE]], code) for r, _, jj in records for code in jj]
+    c.executemany("INSERT INTO papers_jel (pid, code) VALUES (?, ?)", jel)
+
+
+def write_papers(conn, url, papers, records):
+    """Write a single ReDIF document in its own transaction."""
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
         if iserror(papers):
             sql = "UPDATE listings SET status = 2, error = ? WHERE url = ?"
             c.execute(sql, (str(papers), url))
         else:
             sql = "UPDATE listings SET status = 0, error = NULL WHERE url = ?"
             c.execute(sql, (url,))
-            for paper in papers:
-                replace_paper(c, paper, url, alljel)
+            replace_papers(c, records)
+        c.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        raise
+    finally:
         c.close()
-    return not iserror(papers)
 
 
-def update_papers(conn, lock, status=1):
+def islocked(err):
+    """Check if err is a lock timeout."""
+    return isinstance(err, sqlite3.OperationalError) and "locked" in str(err)
+
+
+def update_papers_1(conn, url, alljel):
+    """Update papers from a single ReDIF document."""
+    papers = load(url)
+    # Keep the write transaction short, prepare the records beforehand
+    records = None if iserror(papers) else prepare_papers(papers, url, alljel)
+    for _ in range(LOCK_RETRIES):
+        try:
+            write_papers(conn, url, papers, records)
+            return not iserror(papers)
+        except sqlite3.OperationalError as err:
+            if not islocked(err):
+                raise
+    # Record the failure rather than aborting the whole update
+    try:
+        write_papers(conn, url, RuntimeError("Database is locked"), None)
+    except sqlite3.OperationalError as err:
+        if not islocked(err):
+            raise
+    return False
+
+
+def update_papers(conn, status=1):
     """Update papers from all ReDIF documents."""
     c = conn.cursor()
     c.execute("SELECT code FROM jel WHERE parent IS NOT NULL")
-    alljel = [r[0] for r in c.fetchall()]
+    alljel = frozenset(r[0] for r in c.fetchall())
     c.execute("SELECT url FROM listings WHERE status = ?", (status,))
     urls = [r[0] for r in c.fetchall()]
     urls = random.sample(urls, k=len(urls))  # to redistribute load
     c.close()
 
+    # Each worker thread writes through its own connection
+    local = threading.local()
+    conns = []
+    lock = threading.Lock()
+
     def worker(u):
-        return update_papers_1(conn, lock, u, alljel)
+        if not hasattr(local, "conn"):
+            local.conn = connect()
+            with lock:
+                conns.append(local.conn)
+        return update_papers_1(local.conn, u, alljel)
 
     size = settings.batch_size
     no_batches = math.ceil(len(urls) / size)
@@ -189,27 +316,41 @@ def update_papers(conn, lock, status=1):
     for i in range(no_batches):
         print("Downloading batch {}/{}...".format(i + 1, no_batches))
         batch = urls[i * size : (i + 1) * size]
-        bs = sum(parallel(worker, batch, threads=settings.no_threads_www))
+        try:
+            bs = sum(parallel(worker, batch, threads=settings.no_threads_www))
+        finally:
+            # Worker threads do not outlive a batch
+            while conns:
+                conns.pop().close()
         status += bs
-        conn.commit()
         print(f"{bs} out of {len(batch)} records updated successfully")
 
     print(f"All batches: {status} out of {len(urls)} records" " updated successfully")
 
 
-def update():
-    """Update papers from all ReDIF documents (wrapper)."""
-    conn = sqlite3.connect(settings.database, check_same_thread=False)
+def connect():
+    """Open a database connection in autocommit mode."""
+    conn = sqlite3.connect(
+        settings.database, check_same_thread=False, isolation_level=None
+    )
     c = conn.cursor()
     c.execute("PRAGMA foreign_keys = ON")
+    c.execute("PRAGMA synchronous = NORMAL")
+    c.execute("PRAGMA temp_store = MEMORY")
+    c.execute("PRAGMA mmap_size = 268435456")  # 256 MiB
+    c.execute("PRAGMA busy_timeout = 30000")  # ms
     c.close()
+    return conn
 
-    lock = threading.Lock()
+
+def update():
+    """Update papers from all ReDIF documents (wrapper)."""
+    conn = connect()
+    c = conn.cursor()
+    c.execute("PRAGMA journal_mode = WAL")
+    c.execute("PRAGMA wal_autocheckpoint = 1000")
+    c.close()
     try:
-        update_papers(conn, lock)
-    except BaseException:
-        conn.rollback()
-        raise
-    else:
-        conn.commit()
-    conn.close()
+        update_papers(conn)
+    finally:
+        conn.close()
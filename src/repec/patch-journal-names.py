@@ -24,7 +24,7 @@ def fetch_handles(conn):
 @dbconnection(settings.database)
 def fetch_files(conn, handles):
     """Return a set of files containing given handles."""
-    sql = "SELECT file FROM series WHERE handle = ?"
+    sql = "SELECT file FROM series WHERE handle = ? COLLATE NOCASE"
     c = conn.cursor()
     files = set()
     for handle in handles:
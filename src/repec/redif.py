@@ -5,7 +5,13 @@
 
 # Load global packages
 import re
+import threading
+import zlib
 from collections import defaultdict
+import charset_normalizer
+import msgpack
+import orjson
+import zstandard
 
 # Define constants
 CLUSTERS = set([
@@ -16,19 +22,49 @@ CLUSTERS = set([
     'workplace-name',
 ])
 
+CRLF = re.compile('\r(?!\n)', flags=re.M)
+COMMENT = re.compile('^#.*\n?', flags=re.M)
+FIELD = re.compile(r'(^[a-zA-Z0-9\-#]+:\s*)', flags=re.M)
+
+MARKER = 'template-type'
+
+MSGPACK = b'\x01'  # format byte, absent in older JSON records
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ZSTD_LEVEL = 10
+
+# zstd contexts are not thread-safe, keep one per thread
+_local = threading.local()
+
+
+def detect(rdf):
+    """Guess encoding of a byte string."""
+    match = charset_normalizer.from_bytes(rdf).best()
+    return [match.encoding] if match else []
+
 
 def decode(rdf, hint=[]):
     """Decode ReDIF document."""
+    # For ASCII-compatible encodings, a single byte scan suffices
+    marked = MARKER.encode() in rdf.lower()
+
     def decode(encoding):
+        compatible = MARKER.encode(encoding) == MARKER.encode()
+        if compatible and not marked:
+            raise RuntimeError('Decoding Error')
         rslt = rdf.decode(encoding)
-        if rslt.lower().find('template-type') == -1:
+        if not compatible and rslt.lower().find(MARKER) == -1:
             raise RuntimeError('Decoding Error')
         return rslt
 
-    encodings = hint + ['windows-1252', 'utf-8', 'utf-16', 'latin-1']
-    if rdf[:3] == b'\xef\xbb\xbf':
-        encodings = ['utf-8-sig'] + encodings
-    for enc in encodings:
+    def encodings():
+        if rdf[:3] == b'\xef\xbb\xbf':
+            yield 'utf-8-sig'
+        yield from hint
+        yield from ['windows-1252', 'utf-8', 'utf-16', 'latin-1']
+        # Last resort: detection is slow and mistakes windows-1252 for cp1250
+        yield from detect(rdf)
+
+    for enc in encodings():
         try:
             return decode(enc)
         except Exception:
@@ -36,28 +72,16 @@ def decode(rdf, hint=[]):
     raise RuntimeError('Decoding Error')
 
 
-def split(lst, sel):
-    """Split a list using a selector function."""
-    group = []
-    groups = [group]
-    for el in lst:
-        if sel(el):
-            group = []
-            groups.append(group)
-        group.append(el)
-    return groups
-
-
 def load(rdf):
     """Load ReDIF document."""
     # Repair line endings
-    rdf = re.sub('\r(?!\n)', '\r\n', rdf, flags=re.M)
+    rdf = CRLF.sub('\r\n', rdf)
 
     # Drop comments
-    rdf = re.sub('^#.*\n?', '', rdf, flags=re.M)
+    rdf = COMMENT.sub('', rdf)
 
     # Split fields
-    rdf = re.split(r'(^[a-zA-Z0-9\-#]+:\s*)', rdf, flags=re.M)[1:]
+    rdf = FIELD.split(rdf)[1:]
     rdf = [line.strip() for line in rdf]
     rdf = [
         (rdf[i].rstrip(':').lower(), rdf[i+1])
@@ -68,8 +92,9 @@ def load(rdf):
     rdf = [f for f in rdf if f[1] != '']
 
     # Split templates
-    rdf = split(rdf, lambda x: x[0] == 'template-type')[1:]
-    return rdf
+    bounds = [i for i, (k, _) in enumerate(rdf) if k == 'template-type']
+    ends = bounds[1:] + [len(rdf)]
+    return [rdf[a:b] for a, b in zip(bounds, ends)]
 
 
 def collect(records):
@@ -101,3 +126,31 @@ def collect(records):
     doc = defaultdict(lambda: [])
     helper('', '', doc, 0)
     return doc
+
+
+def compress(blob):
+    """Compress a serialized ReDIF document (zstd)."""
+    if not hasattr(_local, 'cctx'):
+        _local.cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return _local.cctx.compress(blob)
+
+
+def decompress(blob):
+    """Decompress a serialized ReDIF document (zstd or legacy zlib)."""
+    if blob[:4] != ZSTD_MAGIC:
+        return zlib.decompress(blob)
+    if not hasattr(_local, 'dctx'):
+        _local.dctx = zstandard.ZstdDecompressor()
+    return _local.dctx.decompress(blob)
+
+
+def pack(records):
+    """Serialize and compress ReDIF records for storage."""
+    return MSGPACK + compress(msgpack.packb(records, use_bin_type=True))
+
+
+def unpack(blob):
+    """Decompress and deserialize stored ReDIF records."""
+    if blob[:1] == MSGPACK:
+        return msgpack.unpackb(decompress(blob[1:]), raw=False)
+    return orjson.loads(decompress(blob))
@@ -5,51 +5,92 @@
 
 # Load packages
 import re
-from lxml.html import tostring, html5parser
+from lxml import etree
+from lxml.html import fromstring, tostring, html5parser
 import warnings
 
 # Define global settings
 BLOCKTAGS = ["div", "p", "br", "li", "h1", "h2", "h3", "h4", "h5", "h6"]
+INLINETAGS = set(["a", "b", "i", "u", "em", "strong", "span", "sub", "sup"])
 
 EMAIL = re.compile("['a-z0-9._-]+@[a-z0-9._-]+.[a-z]+")
 
+CC = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\x7f\x80-\x9f]")
+CC_TABLE = dict.fromkeys(i for i in range(0xA0) if CC.match(chr(i)))
+SPACE = re.compile(r"\s")
+SPACES = re.compile(r"\s+")
+ENTITY = re.compile(r"&#x?[0-9a-f\s]+;", flags=re.I)
+HTML = re.compile(
+    "<(?:" + "|".join(BLOCKTAGS) + ")>|</|/>|&#?x?[0-9a-z]+;", flags=re.I
+)
+TAG = re.compile(r"<(/?)([a-z][a-z0-9]*)(?:\s[^<>]*?)?(/?)>", flags=re.I)
+NA = re.compile(r"\W*n\W*a\W*", flags=re.I)
+INVALID = re.compile(r"^[\W0-9]*$")
+
 
 def remove_cc(text):
     r"""Remove control characters (except for \t, \r, \n)."""
-    cc = "[\x00-\x08\x0b\x0c\x0e-\x1f\x7f\x80-\x9f]"
-    return re.sub(cc, "", text)
+    # str.translate only beats the regex on longer ASCII text
+    if len(text) > 128 and text.isascii():
+        return text.translate(CC_TABLE)
+    return CC.sub("", text)
 
 
 def sanitize_entity(text):
     """Remove whitespace characters from HTML entities."""
 
     def strip(m):
-        return re.sub(r"\s", "", m.group(0))
+        return SPACE.sub("", m.group(0))
 
-    return re.sub(r"&#x?[0-9a-f\s]+;", strip, text, flags=re.I)
+    return ENTITY.sub(strip, text)
 
 
 def ishtml(text):
     """Guess whether text has html in it."""
-    text = text.lower()
-    for t in BLOCKTAGS:
-        if text.find(f"<{t}>") != -1:
-            return True
-    if text.find("</") != -1 or text.find("/>") != -1:
-        return True
-    if re.search("&#?x?[0-9a-z]+;", text):
-        return True
-    return False
+    return HTML.search(text) is not None
 
 
-def html2text(html):
-    """Render html as text, convert line breaks to spaces."""
-    if not ishtml(html):
-        return re.sub(r"\s+", " ", html.strip())
+def simple_html(html):
+    """Check if html is plain enough for libxml2 to parse it like html5lib."""
+    tags = TAG.findall(html)
+    if len(tags) != html.count("<"):
+        return False
+    stack = []
+    for close, name, selfclose in tags:
+        name = name.lower()
+        if name == "br":
+            if close:
+                return False
+        elif selfclose or (name not in INLINETAGS and name != "p"):
+            return False
+        elif close:
+            if not stack or stack.pop() != name:
+                return False
+        elif name == "p" and stack:
+            return False
+        else:
+            stack.append(name)
+    return not stack
+
+
+def parse_html(html):
+    """Parse simple html with libxml2, anything else with html5lib."""
+    if simple_html(html):
+        try:
+            return fromstring(html)
+        except (etree.ParserError, ValueError):
+            pass
     parser = html5parser.HTMLParser(namespaceHTMLElements=False)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        html = html5parser.fromstring(html, parser=parser)
+        return html5parser.fromstring(html, parser=parser)
+
+
+def html2text(html):
+    """Render html as text, convert line breaks to spaces."""
+    if not ishtml(html):
+        return SPACES.sub(" ", html.strip())
+    html = parse_html(html)
     for b in BLOCKTAGS:
         for e in html.xpath(f"//{b}"):
             e.text = " " + e.text if e.text else ""
@@ -59,12 +100,12 @@ def html2text(html):
             else:
                 e.text = e.text + " "
     text = tostring(html, method="text", encoding="utf-8")
-    return re.sub(r"\s+", " ", text.decode().strip())
+    return SPACES.sub(" ", text.decode().strip())
 
 
 def isna(token):
     """Check if it's an N/A token."""
-    if re.sub(r"\W", "", token).lower() == "na":
+    if NA.fullmatch(token):
         return True
     else:
         return False
@@ -72,7 +113,7 @@ def isna(token):
 
 def isvalid(token):
     """Check if token contains alpha characters."""
-    if re.match(r"^[\W0-9]*$", token):
+    if INVALID.match(token):
         return False
     else:
         return True
@@ -83,7 +124,8 @@ def sanitize(text):
     if type(text) != str:
         return text
     text = remove_cc(text)
-    text = sanitize_entity(text)
+    if "&" in text:
+        text = sanitize_entity(text)
     text = html2text(text)
     if isna(text) or not isvalid(text):
         return None
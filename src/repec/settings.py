@@ -9,7 +9,7 @@ import os
 # Default command line arguments
 database = "./repec.db"
 timeout = 300  # seconds
-batch_size = 10000  # records in each commit
+batch_size = 10000  # records in each download batch
 no_threads_repec = 32
 no_threads_www = 128
 verbosity = 3